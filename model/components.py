@@ -1,14 +1,24 @@
-import torch, copy
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from collections import namedtuple
+from torch.utils.checkpoint import checkpoint
 
 
 
 
 
-def clones(module, N):
-    return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
+@torch.jit.script
+def dropout_add(x, out, p: float, training: bool):
+    return x + F.dropout(out, p, training)
+
+
+
+
+@torch.jit.script
+def dual_dropout_add(x, out_a, out_b, p: float, training: bool):
+    #same as x + dropout(out_a * 0.5 + out_b * 0.5) with one less multiply
+    return x + F.dropout(0.5 * (out_a + out_b), p, training)
 
     
 
@@ -33,14 +43,130 @@ class PositionwiseFeedForward(nn.Module):
 
 
 
+class MultiHeadAttention(nn.Module):
+    def __init__(self, config):
+        super(MultiHeadAttention, self).__init__()
+
+        assert config.hidden_dim % config.n_heads == 0
+        self.n_heads = config.n_heads
+        self.hidden_dim = config.hidden_dim
+        self.head_dim = config.hidden_dim // config.n_heads
+
+        #Packed Q, K, V projections, applied as one GEMM on Self Attention.
+        #Parameter names follow nn.MultiheadAttention to keep checkpoints loadable
+        self.in_proj_weight = nn.Parameter(torch.empty(config.hidden_dim * 3, config.hidden_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(config.hidden_dim * 3))
+        self.out_proj = nn.Linear(config.hidden_dim, config.hidden_dim)
+
+        self.reset_parameters()
+
+
+    def reset_parameters(self):
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.constant_(self.in_proj_bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
+
+
+    def split_heads(self, x):
+        batch_size, seq_len, _ = x.shape
+        x = x.view(batch_size, seq_len, self.n_heads, self.head_dim)
+        return x.transpose(1, 2)
+
+
+    def merge_heads(self, x):
+        batch_size, _, seq_len, _ = x.shape
+        return x.transpose(1, 2).reshape(batch_size, seq_len, -1)
+
+
+    def project_q(self, query):
+        weight, bias = self.in_proj_weight, self.in_proj_bias
+        return self.split_heads(F.linear(query, weight[:self.hidden_dim], bias[:self.hidden_dim]))
+
+
+    def project_kv(self, key, value=None):
+        h, weight, bias = self.hidden_dim, self.in_proj_weight, self.in_proj_bias
+
+        #Key and Value of the same input share a single GEMM
+        if value is None or value is key:
+            k, v = F.linear(key, weight[h:], bias[h:]).chunk(2, dim=-1)
+        else:
+            k = F.linear(key, weight[h:h*2], bias[h:h*2])
+            v = F.linear(value, weight[h*2:], bias[h*2:])
+
+        return self.split_heads(k), self.split_heads(v)
+
+
+    def forward(self, query, key=None, value=None, attn_mask=None, is_causal=False, cache=None, kv=None):
+        #Self Attention when key and value are not given
+        is_self_attn = key is None
+
+        if is_self_attn:
+            qkv = F.linear(query, self.in_proj_weight, self.in_proj_bias)
+            q, k, v = map(self.split_heads, qkv.chunk(3, dim=-1))
+
+            #Self Attention keys and values grow by the newly fed tokens
+            if cache is not None and 'k' in cache:
+                k = torch.cat([cache['k'], k], dim=2)
+                v = torch.cat([cache['v'], v], dim=2)
+        else:
+            q = self.project_q(query)
+
+            #Cross Attention keys and values can be projected beforehand
+            if kv is not None:
+                k, v = kv
+            #and stay the same over decoding steps
+            elif cache is not None and 'k' in cache:
+                k, v = cache['k'], cache['v']
+            else:
+                k, v = self.project_kv(key, value)
+
+        if cache is not None:
+            cache['k'], cache['v'] = k, v
+
+        #Query of a single new token attends to every cached position
+        is_causal = is_causal and q.size(2) == k.size(2)
+
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, is_causal=is_causal
+        )
+
+        return self.out_proj(self.merge_heads(out))
+
+
+
+
+def project_kv_stack(attns, x):
+    #Project x into keys and values of every attention with a single GEMM
+    weight = torch.cat([attn.in_proj_weight[attn.hidden_dim:] for attn in attns])
+    bias = torch.cat([attn.in_proj_bias[attn.hidden_dim:] for attn in attns])
+    out = F.linear(x, weight, bias).chunk(2 * len(attns), dim=-1)
+
+    return [
+        (attn.split_heads(k), attn.split_heads(v))
+        for attn, k, v in zip(attns, out[0::2], out[1::2])
+    ]
+
+
+
+
+def run_layer(layer, *args, grad_ckpt=False, **kwargs):
+    #Recompute layer activations on backward instead of keeping them
+    if grad_ckpt and layer.training:
+        return checkpoint(layer, *args, use_reentrant=False, **kwargs)
+    return layer(*args, **kwargs)
+
+
+
+
 class SublayerConnection(nn.Module):
     def __init__(self, config):
         super(SublayerConnection, self).__init__()
         self.norm = nn.LayerNorm(config.hidden_dim)
         self.dropout = nn.Dropout(config.dropout_ratio)
 
-    def forward(self, x, sublayer):
-        return x + self.dropout(sublayer(self.norm(x)))
+    def forward(self, x, sublayer, *args, **kwargs):
+        out = sublayer(self.norm(x), *args, **kwargs)
+        return dropout_add(x, out, self.dropout.p, self.training)
 
 
 
@@ -49,18 +175,17 @@ class SublayerConnection(nn.Module):
 class LayerBase(nn.Module):
     def __init__(self, config):
         super(LayerBase, self).__init__()
-        
-        self.attn_params = {
-            'embed_dim': config.hidden_dim,
-            'num_heads': config.n_heads,
-            'batch_first': True
-        }
 
         self.enc_fuse = config.enc_fuse
         self.dec_fuse = config.dec_fuse
 
         if self.enc_fuse or self.dec_fuse:
-            self.ple_attn = nn.MultiheadAttention(**self.attn_params)
+            self.ple_attn = MultiHeadAttention(config)
+
+
+    @staticmethod
+    def sub_cache(cache, name):
+        return None if cache is None else cache.setdefault(name, {})
 
 
 
@@ -84,14 +209,55 @@ class ModelBase(nn.Module):
             nn.Dropout(config.dropout_ratio)
         )
 
+        #Causal Mask Setup, sliced to the target length on every call
+        self.register_buffer(
+            'subsequent_mask', 
+            torch.triu(torch.full((config.max_len, config.max_len), float('-inf')), diagonal=1),
+            persistent=False
+        )
+
         #Output Setup
-        self.criterion = nn.CrossEntropyLoss()
+        self.loss_chunk_size = 4096
+        self.label_smoothing = config.label_smoothing
         self.out = namedtuple('Out', 'logit loss')
 
 
-    def ple_project(self, input_ids, attention_mask):
-        out = self.ple(input_ids=input_ids, attention_mask=attention_mask)        
-        return self.ple_mapping(out.last_hidden_state)
+    def ple_project(self, input_ids, attention_mask, ple_out=None):
+        #ple_out holds cached last hidden states of the frozen PLE, stored in float16
+        if ple_out is None:
+            ple_out = self.ple(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        else:
+            ple_out = ple_out.float()
+        return self.ple_mapping(ple_out)
+
+
+    def chunk_loss(self, logit, label):
+        return F.cross_entropy(
+            logit, label, 
+            ignore_index=self.pad_id, 
+            label_smoothing=self.label_smoothing, 
+            reduction='sum'
+        )
+
+
+    def compute_loss(self, logit, label):
+        logit, label = logit.flatten(0, 1), label.flatten()
+        n_tokens = (label != self.pad_id).sum().clamp(min=1)
+
+        #Cross Entropy over row chunks, recomputing each chunk's log-probs on backward,
+        #so that only a (chunk_size, V) fp32 log-prob tensor exists at a time
+        loss = 0
+        for logit_chunk, label_chunk in zip(
+            logit.split(self.loss_chunk_size), label.split(self.loss_chunk_size)
+        ):
+            if torch.is_grad_enabled():
+                loss = loss + checkpoint(
+                    self.chunk_loss, logit_chunk, label_chunk, use_reentrant=False
+                )
+            else:
+                loss = loss + self.chunk_loss(logit_chunk, label_chunk)
+
+        return loss / n_tokens
 
 
     @staticmethod    
@@ -103,6 +269,11 @@ class ModelBase(nn.Module):
         return x == self.pad_id
 
 
+    def attn_mask(self, x):
+        #SDPA keeps True positions, built once and shared by every layer
+        return (x != self.pad_id)[:, None, None, :]
+
+
     def causal_mask(self, y):
         sz = y.size(1)
-        return torch.triu(torch.full((sz, sz), float('-inf')), diagonal=1).to(self.device)
\ No newline at end of file
+        return self.subsequent_mask[:sz, :sz]
\ No newline at end of file
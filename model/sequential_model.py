@@ -1,8 +1,8 @@
 import torch
 import torch.nn as nn
 from .components import (
-    clones, LayerBase, ModelBase,
-    SublayerConnection, PositionwiseFeedForward 
+    LayerBase, ModelBase, MultiHeadAttention,
+    SublayerConnection, PositionwiseFeedForward, project_kv_stack, run_layer
 )
 
 
@@ -13,34 +13,27 @@ class EncoderLayer(LayerBase):
     def __init__(self, config):
         super(EncoderLayer, self).__init__(config)
 
-        self.self_attn = nn.MultiheadAttention(**self.attn_params)
+        self.self_attn = MultiHeadAttention(config)
         self.pff = PositionwiseFeedForward(config)
         
         if self.enc_fuse:
-            self.sublayer = clones(SublayerConnection(config), 3)
+            self.sublayer = nn.ModuleList([SublayerConnection(config) for _ in range(3)])
         else:
-            self.sublayer = clones(SublayerConnection(config), 2)
+            self.sublayer = nn.ModuleList([SublayerConnection(config) for _ in range(2)])
 
 
-    def forward(self, x, p_proj, e_mask):
+    def forward(self, x, p_proj, e_mask, ple_kv=None):
 
         x = self.sublayer[0](
-            x, 
-            lambda x: self.self_attn(
-                x, x, x, 
-                key_padding_mask=e_mask, 
-                need_weights=False
-            )[0]
+            x, self.self_attn, 
+            attn_mask=e_mask
         )
 
         if self.enc_fuse:            
             x = self.sublayer[1](
-                x, 
-                lambda x: self.ple_attn(
-                    x, p_proj, p_proj, 
-                    key_padding_mask=e_mask,
-                    need_weights=False
-                )[0]
+                x, self.ple_attn, p_proj, p_proj, 
+                attn_mask=e_mask,
+                kv=ple_kv
             )
             return self.sublayer[2](x, self.pff)
 
@@ -52,50 +45,43 @@ class DecoderLayer(LayerBase):
     def __init__(self, config):
         super(DecoderLayer, self).__init__(config)
 
-        self.self_attn = nn.MultiheadAttention(**self.attn_params)
-        self.cross_attn = nn.MultiheadAttention(**self.attn_params)
+        self.self_attn = MultiHeadAttention(config)
+        self.cross_attn = MultiHeadAttention(config)
         self.pff = PositionwiseFeedForward(config)
 
         if self.dec_fuse:
-            self.sublayer = clones(SublayerConnection(config), 4)
+            self.sublayer = nn.ModuleList([SublayerConnection(config) for _ in range(4)])
         else:
-            self.sublayer = clones(SublayerConnection(config), 3)
+            self.sublayer = nn.ModuleList([SublayerConnection(config) for _ in range(3)])
 
 
-    def forward(self, x, memory, p_proj, e_mask=None, d_mask=None):
+    def forward(self, x, memory, p_proj, e_mask=None, cache=None, memory_kv=None, ple_kv=None):
         
         x = self.sublayer[0](
-            x, 
-            lambda x: self.self_attn(
-                x, x, x, 
-                attn_mask=d_mask,
-                need_weights=False
-            )[0]
+            x, self.self_attn, 
+            is_causal=True, 
+            cache=self.sub_cache(cache, 'self')
         )
 
         x = self.sublayer[1](
-            x, 
-            lambda x: self.cross_attn(
-                x, memory, memory, 
-                key_padding_mask=e_mask,
-                need_weights=False
-            )[0]
+            x, self.cross_attn, memory, memory, 
+            attn_mask=e_mask,
+            cache=self.sub_cache(cache, 'cross'),
+            kv=memory_kv
         )
 
         if self.dec_fuse:
             x = self.sublayer[2](
-                x, 
-                lambda x: self.ple_attn(
-                    x, p_proj, p_proj, 
-                    key_padding_mask=e_mask,
-                    need_weights=False
-                )[0]
+                x, self.ple_attn, p_proj, p_proj, 
+                attn_mask=e_mask,
+                cache=self.sub_cache(cache, 'ple'),
+                kv=ple_kv
             )
 
-            return self.sublayer[3](x, lambda x: self.pff(x))
+            return self.sublayer[3](x, self.pff)
 
 
-        return self.sublayer[2](x, lambda x: self.pff(x))            
+        return self.sublayer[2](x, self.pff)            
 
 
 
@@ -108,8 +94,9 @@ class Encoder(nn.Module):
             nn.Linear(config.emb_dim, config.hidden_dim),
             nn.Dropout(config.dropout_ratio)
         )
-        self.layers = clones(EncoderLayer(config), config.n_layers)
+        self.layers = nn.ModuleList([EncoderLayer(config) for _ in range(config.n_layers)])
         self.norm = nn.LayerNorm(config.hidden_dim)
+        self.grad_ckpt = config.grad_ckpt
 
 
 
@@ -117,8 +104,16 @@ class Encoder(nn.Module):
 
         x = self.emb_mapping(x)
 
-        for layer in self.layers:
-            x = layer(x, ple_out, e_mask)
+        #ple_out is shared by every layer, so project it for all layers at once
+        ple_kv = [None] * len(self.layers)
+        if ple_out is not None:
+            ple_kv = project_kv_stack([layer.ple_attn for layer in self.layers], ple_out)
+
+        for layer, layer_ple_kv in zip(self.layers, ple_kv):
+            x = run_layer(
+                layer, x, ple_out, e_mask, layer_ple_kv, 
+                grad_ckpt=self.grad_ckpt
+            )
 
         return self.norm(x)
 
@@ -134,17 +129,37 @@ class Decoder(nn.Module):
             nn.Dropout(config.dropout_ratio)
         )
         
-        self.layers = clones(DecoderLayer(config), config.n_layers)
+        self.layers = nn.ModuleList([DecoderLayer(config) for _ in range(config.n_layers)])
         self.norm = nn.LayerNorm(config.hidden_dim)
+        self.grad_ckpt = config.grad_ckpt
         
 
 
-    def forward(self, x, memory, ple_out=None, e_mask=None, d_mask=None):
+    def init_cache(self):
+        return [dict() for _ in self.layers]
+
+
+    def forward(self, x, memory, ple_out=None, e_mask=None, cache=None):
         
         x = self.emb_mapping(x)
+        n_layers = len(self.layers)
+
+        #memory and ple_out are shared by every layer, so project them for all layers at once.
+        #Cached decoding keeps the projections of its first step
+        memory_kv = ple_kv = [None] * n_layers
+        if cache is None or not cache[0]:
+            memory_kv = project_kv_stack([layer.cross_attn for layer in self.layers], memory)
+            if ple_out is not None:
+                ple_kv = project_kv_stack([layer.ple_attn for layer in self.layers], ple_out)
+
+        cache = [None] * n_layers if cache is None else cache
         
-        for layer in self.layers:
-            x = layer(x, memory, ple_out, e_mask, d_mask)
+        for layer, layer_cache, layer_memory_kv, layer_ple_kv in zip(self.layers, cache, memory_kv, ple_kv):
+            x = run_layer(
+                layer, x, memory, ple_out, e_mask, 
+                layer_cache, layer_memory_kv, layer_ple_kv, 
+                grad_ckpt=self.grad_ckpt
+            )
 
         return self.norm(x)
 
@@ -160,27 +175,24 @@ class SequentialModel(ModelBase):
         self.generator = nn.Linear(config.hidden_dim, self.vocab_size)
 
 
-    def forward(self, input_ids, attention_mask, labels):        
+    def forward(self, input_ids, attention_mask, labels, ple_out=None):        
         #Prerequisites
         x = input_ids 
         y, label = self.shift_y(labels)
-        e_mask, d_mask = self.pad_mask(x), self.causal_mask(y)
+        e_mask = self.attn_mask(x)
 
         #Embedding
         x = self.ple.embeddings(x)
         y = self.ple.embeddings(y)
 
         #Actual Process
-        p_proj = self.ple_project(input_ids, attention_mask)
+        p_proj = self.ple_project(input_ids, attention_mask, ple_out)
         memory = self.encoder(x, p_proj if self.enc_fuse else None, e_mask)
-        d_out = self.decoder(y, memory, p_proj if self.dec_fuse else None, e_mask, d_mask)
+        d_out = self.decoder(y, memory, p_proj if self.dec_fuse else None, e_mask)
         logit = self.generator(d_out)
         
         self.out.logit = logit
-        self.out.loss = self.criterion(
-            logit.contiguous().view(-1, self.vocab_size), 
-            label.contiguous().view(-1)
-        )
+        self.out.loss = self.compute_loss(logit, label)
 
         return self.out
 
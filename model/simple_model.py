@@ -1,6 +1,6 @@
 import copy, math, torch
 import torch.nn as nn
-from .components import clones, ModelBase
+from .components import ModelBase, run_layer
 
 
 
@@ -15,9 +15,13 @@ class Encoder(nn.Module):
             nn.Dropout(config.dropout_ratio)
         )
 
-    def forward(self, x, e_mask=None):
-        x = self.ple(input_ids=x, attention_mask=e_mask).last_hidden_state
-        return self.enc_mapping(x)
+    def forward(self, x, e_mask=None, ple_out=None):
+        #ple_out holds cached last hidden states of the frozen PLE, stored in float16
+        if ple_out is None:
+            ple_out = self.ple(input_ids=x, attention_mask=e_mask).last_hidden_state
+        else:
+            ple_out = ple_out.float()
+        return self.enc_mapping(ple_out)
 
 
 
@@ -31,26 +35,30 @@ class Decoder(nn.Module):
             nn.Dropout(config.dropout_ratio)
         )
 
-        layer = nn.TransformerDecoderLayer(
-            d_model=config.hidden_dim,
-            nhead=config.n_heads,
-            dim_feedforward=config.pff_dim,
-            dropout=config.dropout_ratio,
-            activation='gelu',
-            batch_first=True,
-            norm_first=True
-        )
-        self.layers = clones(layer, config.n_layers)
+        self.layers = nn.ModuleList([
+            nn.TransformerDecoderLayer(
+                d_model=config.hidden_dim,
+                nhead=config.n_heads,
+                dim_feedforward=config.pff_dim,
+                dropout=config.dropout_ratio,
+                activation='gelu',
+                batch_first=True,
+                norm_first=True
+            ) for _ in range(config.n_layers)
+        ])
+        self.grad_ckpt = config.grad_ckpt
 
 
     def forward(self, x, memory, e_mask=None, d_mask=None):
         x = self.emb_mapping(x)
 
         for layer in self.layers:
-            x = layer(
-                x, memory, 
+            x = run_layer(
+                layer, x, memory, 
                 memory_key_padding_mask=e_mask,
                 tgt_mask=d_mask,
+                tgt_is_causal=d_mask is not None,
+                grad_ckpt=self.grad_ckpt
             )
 
         return x
@@ -67,7 +75,7 @@ class SimpleModel(ModelBase):
 
 
 
-    def forward(self, input_ids, attention_mask, labels):
+    def forward(self, input_ids, attention_mask, labels, ple_out=None):
         y, label = self.shift_y(labels)
 
         e_mask = self.pad_mask(input_ids)
@@ -75,14 +83,11 @@ class SimpleModel(ModelBase):
         
         y = self.encoder.ple.embeddings(y)
 
-        memory = self.encoder(input_ids, attention_mask)
+        memory = self.encoder(input_ids, attention_mask, ple_out)
         dec_out = self.decoder(y, memory, e_mask, causal_mask)
         logit = self.generator(dec_out)
 
         self.out.logit = logit
-        self.out.loss = self.criterion(
-            logit.contiguous().view(-1, self.vocab_size), 
-            label.contiguous().view(-1)
-        )
+        self.out.loss = self.compute_loss(logit, label)
 
         return self.out
@@ -1,4 +1,4 @@
-from .data import load_dataloader
+from .data import load_dataloader, cache_ple_out
 from .model import load_model
 from .train import Trainer
 from .test import Tester
@@ -1,13 +1,39 @@
-import json, torch
-from torch.utils.data import DataLoader
+import os, json, torch
+import numpy as np
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
 
 
 
+def ple_cache_path(config, split):
+    ple_name = config.ple_name.replace('/', '_')
+    return f"data/{config.task}/{split}_{ple_name}.npy"
+
+
+
+
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, task, split):
+    def __init__(self, task, split, pad_id, ple_cache_path=None):
         super().__init__()
-        self.data = self.load_data(task, split)
+        data = self.load_data(task, split)
+
+        x_ids = [elem['x_ids'] for elem in data]
+        y_ids = [elem['y_ids'] for elem in data]
+
+        self.x_lens = [len(ids) for ids in x_ids]
+        self.y_lens = [len(ids) for ids in y_ids]
+
+        #Pre-padded id tensors, built once instead of on every batch
+        self.x_ids = self.stack_ids(x_ids, pad_id)
+        self.y_ids = self.stack_ids(y_ids, pad_id)
+
+        #Cached PLE last hidden states, flattened over tokens and memory-mapped
+        self.ple_out = None
+        if ple_cache_path is not None:
+            self.ple_out = np.load(ple_cache_path, mmap_mode='r')
+            self.x_offsets = np.cumsum([0] + self.x_lens).tolist()
+            assert self.ple_out.shape[0] == self.x_offsets[-1]
 
 
     @staticmethod
@@ -17,47 +43,156 @@ class Dataset(torch.utils.data.Dataset):
         return data
 
 
+    @staticmethod
+    def stack_ids(ids_list, pad_id):
+        max_len = max(len(ids) for ids in ids_list)
+        stacked = torch.full((len(ids_list), max_len), pad_id, dtype=torch.int32)
+        
+        for idx, ids in enumerate(ids_list):
+            stacked[idx, :len(ids)] = torch.tensor(ids, dtype=torch.int32)
+        
+        return stacked
+
+
     def __len__(self):
-        return len(self.data)
+        return len(self.x_lens)
     
 
     def __getitem__(self, idx):
-        return self.data[idx]['x'], self.data[idx]['y']
+        elem = (self.x_ids[idx], self.y_ids[idx], self.x_lens[idx], self.y_lens[idx])
+
+        if self.ple_out is not None:
+            start, end = self.x_offsets[idx], self.x_offsets[idx + 1]
+            elem += (torch.from_numpy(np.array(self.ple_out[start:end])),)
+
+        return elem
+
+
+
+class BucketSampler(Sampler):
+    def __init__(self, dataset, batch_size, shuffle):
+        self.shuffle = shuffle
+
+        #Group similar length sequences to cut down padding
+        lengths = list(zip(dataset.x_lens, dataset.y_lens))
+        indices = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        self.batches = [indices[i: i + batch_size] for i in range(0, len(indices), batch_size)]
+
+
+    def __len__(self):
+        return len(self.batches)
+
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.batches)).tolist()
+        else:
+            order = range(len(self.batches))
+
+        for i in order:
+            yield self.batches[i]
 
 
 
 class Collator(object):
-    def __init__(self, tokenizer):
-        self.tokenizer = tokenizer
-
-    def tokenize(self, batch):
-        return self.tokenizer(
-            batch, 
-            padding=True, 
-            truncation=True, 
-            return_tensors='pt'
-        )
+    def __init__(self, pad_id, len_multiple=1):
+        self.pad_id = pad_id
+        self.len_multiple = len_multiple
+
+    def stack_batch(self, batch, lens):
+        #Trim the pre-padded rows down to the longest sequence in the batch, rounded up
+        #to len_multiple when CUDA graphs should be captured for fewer shapes
+        batch = torch.stack(batch)
+        seq_len = -(-max(lens) // self.len_multiple) * self.len_multiple
+        return batch[:, :min(seq_len, batch.size(1))].long()
 
     def __call__(self, batch):
-        x_batch, y_batch = zip(*batch)
+        x_batch, y_batch, x_lens, y_lens, *ple_out = zip(*batch)
+
+        x_batch = self.stack_batch(x_batch, x_lens)
+        y_batch = self.stack_batch(y_batch, y_lens)
+
+        batch = {'input_ids': x_batch, 
+                 'attention_mask': (x_batch != self.pad_id).long(),
+                 'labels': y_batch}
+
+        if ple_out:
+            ple_out = pad_sequence(ple_out[0], batch_first=True)
+            batch['ple_out'] = F.pad(ple_out, (0, 0, 0, x_batch.size(1) - ple_out.size(1)))
+
+        return batch
+
+
+
+
+def cache_ple_out(config, ple):
+    ple.eval()
+
+    for split in ['train', 'valid']:
+        path = ple_cache_path(config, split)
+        if os.path.exists(path):
+            continue
+
+        #Written to a temporary file first, so that an interrupted run is never taken as a finished cache
+        tmp_path = path + '.tmp'
+        dataset = Dataset(config.task, split, config.pad_id)
+        cache = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.float16,
+            shape=(sum(dataset.x_lens), ple.config.hidden_size)
+        )
+
+        offset = 0
+        with torch.inference_mode():
+            for idx in range(0, len(dataset), config.batch_size):
+                x_lens = dataset.x_lens[idx: idx + config.batch_size]
+                x_ids = dataset.x_ids[idx: idx + config.batch_size, :max(x_lens)]
+                x_ids = x_ids.long().to(config.device)
+
+                out = ple(input_ids=x_ids, attention_mask=(x_ids != config.pad_id).long())
+                out = out.last_hidden_state.half().cpu().numpy()
+
+                for elem_out, x_len in zip(out, x_lens):
+                    cache[offset: offset + x_len] = elem_out[:x_len]
+                    offset += x_len
+
+        cache.flush()
+        del cache
+        os.replace(tmp_path, path)
+        print(f"PLE outputs of {split.upper()} split have cached on {path}")
+
+
 
-        x_encodings = self.tokenize(x_batch)
-        y_encodings = self.tokenize(y_batch)
 
-        return {'input_ids': x_encodings.input_ids, 
-                'attention_mask': x_encodings.attention_mask,
-                'labels': y_encodings.input_ids}
+def load_dataloader(config, split):
 
+    use_cache = config.ple_cache and split != 'test'
+    dataset = Dataset(
+        config.task, split, config.pad_id, 
+        ple_cache_path(config, split) if use_cache else None
+    )
 
+    #Half of the cores up to 8 for train, and half of that for valid & test
+    num_workers = min((os.cpu_count() or 2) // 2, 8)
+    num_workers = num_workers if split == 'train' else num_workers // 2
 
+    #Batch lengths are rounded only for loaders feeding CUDA graphs of reduce-overhead compile
+    use_graphs = config.mode == 'train' and config.compile_mode == 'reduce-overhead'
+    len_multiple = config.len_multiple if use_graphs else 1
 
-def load_dataloader(config, tokenizer, split):
+    #Test keeps the original order, since its score is averaged over batches
+    if split == 'test':
+        batch_params = {'batch_size': config.batch_size, 'shuffle': False}
+    else:
+        batch_params = {'batch_sampler': BucketSampler(
+            dataset, config.batch_size, shuffle=split == 'train'
+        )}
 
     return DataLoader(
-        Dataset(config.task, split), 
-        batch_size=config.batch_size, 
-        shuffle=split == 'train',
-        collate_fn=Collator(tokenizer),
+        dataset, 
+        **batch_params,
+        collate_fn=Collator(config.pad_id, len_multiple),
         pin_memory=True,
-        num_workers=2
+        num_workers=max(num_workers, 1),
+        persistent_workers=True,
+        prefetch_factor=4
     )
\ No newline at end of file
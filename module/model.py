@@ -37,7 +37,11 @@ def init_weights(model):
 
 
 def load_ple(config):
-    ple = AutoModel.from_pretrained(config.ple_name)
+    #Fall back to the default attention where sdpa is not supported
+    try:
+        ple = AutoModel.from_pretrained(config.ple_name, attn_implementation='sdpa')
+    except ValueError:
+        ple = AutoModel.from_pretrained(config.ple_name)
 
     #Extend Max Position Embeddings if needed
     if ple.config.max_position_embeddings < config.max_len:
@@ -87,4 +91,10 @@ def load_model(config):
         print(f"Trained Model States has loaded on the Model")
 
     print_model_desc(model)
-    return model.to(config.device)
\ No newline at end of file
+    model = model.to(config.device)
+
+    #Fuse small pointwise ops of the Encoder/Decoder stacks
+    if config.mode == 'train' and config.compile_mode:
+        model = torch.compile(model, mode=config.compile_mode, fullgraph=False, backend='inductor')
+
+    return model
\ No newline at end of file
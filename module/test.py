@@ -18,6 +18,7 @@ class Tester:
         self.eos_id = config.eos_id
         self.device = config.device
         self.max_len = config.max_len
+        self.check_every = 16
 
         self.enc_fuse = config.enc_fuse
         self.dec_fuse = config.dec_fuse
@@ -32,12 +33,12 @@ class Tester:
         score = 0.0
         self.model.eval()
 
-        with torch.no_grad():
+        with torch.inference_mode():
             for batch in self.dataloader:
                 
-                input_ids = batch['input_ids'].to(self.device)
-                attention_mask = batch['attention_mask'].to(self.device)
-                labels = batch['labels'].to(self.device)
+                input_ids = batch['input_ids'].to(self.device, non_blocking=True)
+                attention_mask = batch['attention_mask'].to(self.device, non_blocking=True)
+                labels = batch['labels'].to(self.device, non_blocking=True)
 
                 if self.fusion_type == 'simple':
                     pred = self.simple_predict(input_ids, attention_mask)
@@ -56,9 +57,12 @@ class Tester:
     def simple_predict(self, input_ids, attention_mask):
         #Prerequisites
         batch_size = input_ids.size(0)
-        pred = torch.zeros((batch_size, self.max_len), dtype=torch.long)
-        pred = pred.fill_(self.pad_id).to(self.device)
+        pred = torch.full(
+            (batch_size, self.max_len), self.pad_id, 
+            dtype=torch.long, device=self.device
+        )
         pred[:, 0] = self.bos_id
+        done = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
 
         e_mask = self.model.pad_mask(input_ids)
         memory = self.model.encoder(input_ids, attention_mask)
@@ -67,12 +71,16 @@ class Tester:
         for idx in range(1, self.max_len):
             y = pred[:, :idx]
             y = self.model.encoder.ple.embeddings(y)
-            d_out = self.model.decoder(y, memory, e_mask, None)
+            d_out = self.model.decoder(y, memory, e_mask, self.model.causal_mask(y))
             logit = self.model.generator(d_out)
-            pred[:, idx] = logit.argmax(dim=-1)[:, -1]
+            next_token = logit.argmax(dim=-1)[:, -1]
 
-            #Early Stop Condition
-            if (pred == self.eos_id).sum().item() == batch_size:
+            #Rows that already ended keep padding until the host check stops the loop
+            pred[:, idx] = torch.where(done, self.pad_id, next_token)
+
+            #Early Stop Condition, synced to host only every few steps
+            done |= pred[:, idx] == self.eos_id
+            if idx % self.check_every == 0 and done.all().item():
                 break
 
         return pred
@@ -83,26 +91,36 @@ class Tester:
     def fusion_predict(self, input_ids, attention_mask):
         #Prerequisites
         batch_size = input_ids.size(0)
-        pred = torch.zeros((batch_size, self.max_len), dtype=torch.long)
-        pred = pred.fill_(self.pad_id).to(self.device)
+        pred = torch.full(
+            (batch_size, self.max_len), self.pad_id, 
+            dtype=torch.long, device=self.device
+        )
         pred[:, 0] = self.bos_id
+        done = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
 
         x = input_ids
         x = self.model.ple.embeddings(x)
-        e_mask = self.model.pad_mask(input_ids)
+        e_mask = self.model.attn_mask(input_ids)
         p_proj = self.model.ple_project(input_ids, attention_mask)
         memory = self.model.encoder(x, p_proj if self.enc_fuse else None, e_mask)
 
-        #Decoding
+        #Decoding, feeding only the latest token along with cached keys and values
+        cache = self.model.decoder.init_cache()
         for idx in range(1, self.max_len):
-            y = pred[:, :idx]
-            y = self.model.ple.embeddings(y)
-            d_out = self.model.decoder(y, memory, p_proj if self.dec_fuse else None, e_mask, None)
+            y = pred[:, idx-1:idx]
+            y = self.model.ple.embeddings(y, past_key_values_length=idx-1)
+            d_out = self.model.decoder(
+                y, memory, p_proj if self.dec_fuse else None, e_mask, cache
+            )
             logit = self.model.generator(d_out)
-            pred[:, idx] = logit.argmax(dim=-1)[:, -1]
+            next_token = logit.argmax(dim=-1)[:, -1]
+
+            #Rows that already ended keep padding until the host check stops the loop
+            pred[:, idx] = torch.where(done, self.pad_id, next_token)
 
-            #Early Stop Condition
-            if (pred == self.eos_id).sum().item() == batch_size:
+            #Early Stop Condition, synced to host only every few steps
+            done |= pred[:, idx] == self.eos_id
+            if idx % self.check_every == 0 and done.all().item():
                 break
 
         return pred
@@ -111,8 +129,8 @@ class Tester:
 
     def evaluate(self, pred, label):
         #Tokenize
-        pred = [self.tokenizer.decode(x) for x in pred.tolist()]
-        label = [self.tokenizer.decode(x) for x in label.tolist()]
+        pred = self.tokenizer.batch_decode(pred.tolist())
+        label = self.tokenizer.batch_decode(label.tolist())
 
         #End Condition
         if all(elem == '' for elem in pred):
@@ -21,8 +21,14 @@ class Trainer:
         self.vocab_size = config.vocab_size
         self.early_stop = config.early_stop
         self.device_type = config.device_type
-        self.scaler = torch.cuda.amp.GradScaler()
+
+        #bf16 needs no loss scaling, so GradScaler only works for fp16
+        use_bf16 = self.device_type == 'cpu' or torch.cuda.is_bf16_supported()
+        self.amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+        self.scaler = amp.GradScaler(self.device_type, enabled=not use_bf16)
+
         self.iters_to_accumulate = config.iters_to_accumulate        
+        self.compile_mode = config.compile_mode
 
         self.optimizer = AdamW(self.model.parameters(), lr=config.lr)
         #self.optimizer = AdamW(filter(lambda p: p.requires_grad, self.model.parameters()), lr=config.lr)
@@ -91,8 +97,10 @@ class Trainer:
             #save best model
             if best_loss > valid_epoch_loss:
                 best_loss = valid_epoch_loss
+                #torch.compile wraps the original model in _orig_mod
+                model = getattr(self.model, '_orig_mod', self.model)
                 torch.save({'epoch': epoch,
-                            'model_state_dict': self.model.state_dict(),
+                            'model_state_dict': model.state_dict(),
                             'optimizer_state_dict': self.optimizer.state_dict()},
                             self.ckpt)
 
@@ -119,13 +127,20 @@ class Trainer:
     def train_epoch(self):
         self.model.train()
         tot_len = len(self.train_dataloader)
-        epoch_loss = 0
+
+        #Accumulated on device to avoid a host sync on every step
+        epoch_loss = torch.zeros((), device=self.device)
 
         for idx, batch in enumerate(self.train_dataloader):
             idx += 1
-            batch = {k: v.to(self.device) for k, v in batch.items()}
+            batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
 
-            with torch.autocast(device_type=self.device_type, dtype=torch.float16):
+            #Sequence length varies across batches
+            if self.compile_mode:
+                for v in batch.values():
+                    torch._dynamo.mark_dynamic(v, 1)
+
+            with torch.autocast(device_type=self.device_type, dtype=self.amp_dtype):
                 loss = self.model(**batch).loss
                 loss = loss / self.iters_to_accumulate
             
@@ -143,23 +158,27 @@ class Trainer:
                 
                 self.optimizer.zero_grad()
 
-            epoch_loss += loss.item()
+            epoch_loss += loss.detach()
         
-        return round(epoch_loss / tot_len, 3)
+        return round(epoch_loss.item() / tot_len, 3)
     
 
 
 
     def valid_epoch(self):
         self.model.eval()
-        epoch_loss = 0
+        epoch_loss = torch.zeros((), device=self.device)
         
         with torch.no_grad():
             for batch in self.valid_dataloader:
-                batch = {k: v.to(self.device) for k, v in batch.items()}
+                batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+                if self.compile_mode:
+                    for v in batch.values():
+                        torch._dynamo.mark_dynamic(v, 1)
                 
-                with torch.autocast(device_type=self.device_type, dtype=torch.float16):
+                with torch.autocast(device_type=self.device_type, dtype=self.amp_dtype):
                     loss = self.model(**batch).loss
-                    epoch_loss += loss.item()
+                    epoch_loss += loss.detach()
         
-        return round(epoch_loss / len(self.valid_dataloader), 3)        
\ No newline at end of file
+        return round(epoch_loss.item() / len(self.valid_dataloader), 3)        
\ No newline at end of file
@@ -3,7 +3,7 @@ from tokenizers import Tokenizer
 from tokenizers.processors import TemplateProcessing
 from transformers import set_seed, AutoTokenizer
 from module import (
-    load_model, load_dataloader,
+    load_model, load_dataloader, cache_ple_out,
     Trainer, Tester, SeqGenerator
 )
 
@@ -63,19 +63,24 @@ def load_tokenizer(config):
 
 def main(args):
     set_seed(42)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     config = Config(args)
     tokenizer = load_tokenizer(config)
     model = load_model(config)
 
 
     if config.mode == 'train':
-        train_dataloader = load_dataloader(config, tokenizer, 'train')
-        valid_dataloader = load_dataloader(config, tokenizer, 'valid')
+        if config.ple_cache:
+            cache_ple_out(config, model.ple)
+
+        train_dataloader = load_dataloader(config, 'train')
+        valid_dataloader = load_dataloader(config, 'valid')
         trainer = Trainer(config, model, train_dataloader, valid_dataloader)
         trainer.train()
     
     elif config.mode == 'test':
-        test_dataloader = load_dataloader(config, tokenizer, 'test')
+        test_dataloader = load_dataloader(config, 'test')
         tester = Tester(config, model, tokenizer, test_dataloader)
         tester.test()    
     
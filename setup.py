@@ -1,5 +1,6 @@
 import os, re, json, yaml, argparse
 from datasets import load_dataset
+from transformers import AutoTokenizer
 
 
 
@@ -137,6 +138,26 @@ def process_summarization_data(data_volumn):
 
 
 
+def tokenize_data(task, data_obj):
+    with open('config.yaml', 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    max_len = config['train']['max_len']
+    max_len = max_len * 2 if 'sum' in task else max_len
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        config['model']['ple_name'], model_max_length=max_len
+    )
+
+    #Encode whole sequences at once
+    x_ids = tokenizer([elem['x'] for elem in data_obj], truncation=True).input_ids
+    y_ids = tokenizer([elem['y'] for elem in data_obj], truncation=True).input_ids
+
+    return [{'x_ids': x, 'y_ids': y} for x, y in zip(x_ids, y_ids)]
+
+
+
+
 def save_data(task, data_obj):
     #split data into train/valid/test sets
     train, valid, test = data_obj[:-5100], data_obj[-5100:-100], data_obj[-100:]
@@ -163,8 +184,9 @@ def main(task):
     elif task == 'summarization':
         processed = process_summarization_data(data_volumn)
 
-    #Save Data
-    save_data(task, processed)
+    #Tokenize & Save Data
+    tokenized = tokenize_data(task, processed)
+    save_data(task, tokenized)
 
 
 